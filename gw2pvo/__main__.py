@@ -6,11 +6,18 @@ if sys.version_info < (3,6):
 
 import logging
 import argparse
+import hashlib
+import json
 import locale
+import tempfile
 import time
-from datetime import datetime
+from collections import deque
+from datetime import datetime, date
+from types import SimpleNamespace
 from configparser import ConfigParser
 
+import requests
+
 from astral import LocationInfo
 from astral.geocoder import lookup, database
 from astral.location import Location
@@ -28,7 +35,62 @@ __license__ = "MIT"
 __email__ = "mark@paracas.nl"
 __doc__ = "Upload GoodWe power inverter data to PVOutput.org"
 
-last_eday_kwh = 0
+log = logging.getLogger("gw2pvo")
+
+# Readings waiting to be uploaded in one PVOutput batch call
+pvo_batch = deque(maxlen=30)
+
+def flush_batch(pvo):
+    ''' Upload any readings still waiting in the batch queue. '''
+    if pvo and pvo_batch:
+        pvo.add_batch_status(pvo_batch)
+        pvo_batch.clear()
+
+_sun_cache = {}
+
+def readings_cache_path(station_id):
+    ''' Cache file for readings shared between rapidly restarting processes.
+
+    Keyed by uid and station, so instances uploading different stations
+    (or run by different users) never serve each other's readings.
+    '''
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    digest = hashlib.sha1(station_id.encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), 'gw2pvo_{}_{}.json'.format(uid, digest))
+
+def get_cached_readings(path, ttl):
+    ''' Return the readings left behind by a recent run, or None when stale. '''
+    try:
+        if time.time() - os.stat(path).st_mtime < ttl:
+            with open(path) as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    return None
+
+def save_cached_readings(path, data):
+    try:
+        with open(path, 'w') as f:
+            json.dump(data, f)
+    except (OSError, TypeError):
+        pass
+
+_TRUE_WORDS = frozenset(('true', 'yes', 'on', '1'))
+
+def to_bool(value):
+    ''' Coerce a config-file string like "yes" or "on" to a boolean. '''
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in _TRUE_WORDS
+
+def get_sun_times(city):
+    ''' Return today's (dawn, dusk) times, computing them at most once per day. '''
+    today = date.today()
+    cached = _sun_cache.get(today)
+    if cached is None:
+        _sun_cache.clear()
+        cached = _sun_cache[today] = (city.dawn().time(), city.dusk().time())
+    return cached
 
 def get_temperature(settings, latitude, longitude):
     if settings.netatmo_username and settings.netatmo_password and settings.netatmo_client_id and settings.netatmo_client_secret:
@@ -48,57 +110,68 @@ def get_temperature(settings, latitude, longitude):
         return ds.get_temperature(latitude, longitude)
     return None
 
-def run_once(settings, city):
-    global last_eday_kwh
+def run_once(settings, gw, pvo, city, csv=None, last_eday_kwh=0):
+    # Take one clock snapshot per iteration, so all checks agree on the time
+    now = datetime.now()
 
     # Check if we only want to run during daylight
     if city:
-        now = datetime.time(datetime.now())
-        if now < city.dawn().time() or now > city.dusk().time():
-            logging.debug("Skipped upload as it's night")
-            return
+        dawn, dusk = get_sun_times(city)
+        if now.time() < dawn or now.time() > dusk:
+            log.debug("Skipped upload as it's night")
+            return last_eday_kwh
+
+    # Fetch the last reading from GoodWe, unless a fresh enough one is cached
+    # from a previous (possibly restarted) run
+    data = get_cached_readings(settings.readings_cache, settings.pvo_interval * 30) if settings.pvo_interval else None
+    if data is None:
+        data = gw.getCurrentReadings()
+        save_cached_readings(settings.readings_cache, data)
+    else:
+        log.debug("Using cached readings")
 
-    # Fetch the last reading from GoodWe
-    gw = gw_api.GoodWeApi(settings.gw_station_id, settings.gw_account, settings.gw_password)
-    data = gw.getCurrentReadings()
+    is_offline = data.get('status') == 'Offline'
 
     # Check if we want to abort when offline
-    if settings.skip_offline:
-        if data['status'] == 'Offline':
-            logging.debug("Skipped upload as the inverter is offline")
-            return
+    if settings.skip_offline and is_offline:
+        log.debug("Skipped upload as the inverter is offline")
+        return last_eday_kwh
 
     # Append reading to CSV file
-    if settings.csv:
-        if data['status'] == 'Offline':
-            logging.debug("Don't append offline data to CSV file")
+    if csv:
+        if is_offline:
+            log.debug("Don't append offline data to CSV file")
         else:
-            locale.setlocale(locale.LC_ALL, locale.getlocale())
-            csv = gw_csv.GoodWeCSV(settings.csv)
             csv.append(data)
 
     # Submit reading to PVOutput, if they differ from the previous set
     eday_kwh = data['eday_kwh']
-    if data['pgrid_w'] == 0 and abs(eday_kwh - last_eday_kwh) < 0.001:
-        logging.debug("Ignore unchanged reading")
+    pgrid_w = data['pgrid_w']
+    if pgrid_w == 0 and abs(eday_kwh - last_eday_kwh) < 0.001:
+        log.debug("Ignore unchanged reading")
     else:
         last_eday_kwh = eday_kwh
 
     temperature = get_temperature(settings, data['latitude'], data['longitude'])
     if temperature:
-        logging.info("Current local temperature is {:.1f} °C".format(temperature))
-        data['temperature'] = temperature
+        log.info("Current local temperature is %.1f °C", temperature)
 
-    voltage = data['grid_voltage']
-    if settings.pv_voltage:
-        voltage=data['pv_voltage']
+    voltage = data['pv_voltage'] if settings.pv_voltage else data['grid_voltage']
 
-    if settings.pvo_system_id and settings.pvo_api_key:
-        pvo = pvo_api.PVOutputApi(settings.pvo_system_id, settings.pvo_api_key)
-        pvo.add_status(data['pgrid_w'], last_eday_kwh, data.get('temperature'), voltage)
+    if pvo:
+        if settings.pvo_batch_size > 1:
+            # Accumulate readings and amortize the HTTP overhead over a batch
+            pvo_batch.append(pvo.format_status(pgrid_w, last_eday_kwh, temperature, voltage))
+            if len(pvo_batch) >= settings.pvo_batch_size:
+                pvo.add_batch_status(pvo_batch)
+                pvo_batch.clear()
+        else:
+            pvo.add_status(pgrid_w, last_eday_kwh, temperature, voltage)
     else:
-        logging.debug(str(data))
-        logging.warning("Missing PVO id and/or key")
+        log.debug("%s", data)
+        log.warning("Missing PVO id and/or key")
+
+    return last_eday_kwh
 
 def copy(settings):
     # Fetch readings from GoodWe
@@ -119,16 +192,22 @@ def copy(settings):
         pvo.add_day(data['entries'], temperatures)
     else:
         for entry in data['entries']:
-            logging.info("{}: {:6.0f} W {:6.2f} kWh".format(
+            log.info("%s: %6.0f W %6.2f kWh",
                 entry['dt'],
                 entry['pgrid_w'],
                 entry['eday_kwh'],
-            ))
-        logging.warning("Missing PVO id and/or key")
+            )
+        log.warning("Missing PVO id and/or key")
 
 def run():
+    # Parser-level defaults; config-file settings override these. Don't pass
+    # default= to add_argument for these options, or set_defaults is shadowed
+    # and config-file values never reach the parsed args.
     defaults = {
-        'log': "info"
+        'log': "info",
+        'pv_voltage': False,
+        'skip_offline': False,
+        'pvo_batch_size': 1,
     }
 
     # Parse any config file specification. We make this parser with add_help=False so
@@ -161,6 +240,7 @@ def run():
     parser.add_argument("--pvo-system-id", help="PVOutput system ID", metavar='ID')
     parser.add_argument("--pvo-api-key", help="PVOutput API key", metavar='KEY')
     parser.add_argument("--pvo-interval", help="PVOutput interval in minutes", type=int, choices=[5, 10, 15])
+    parser.add_argument("--pvo-batch-size", help="Upload readings in batches of this size (default 1, max 30)", type=int, metavar='N')
     parser.add_argument("--darksky-api-key", help="Dark Sky Weather API key")
     parser.add_argument("--netatmo-username", help="Netatmo username")
     parser.add_argument("--netatmo-password", help="Netatmo password")
@@ -169,8 +249,8 @@ def run():
     parser.add_argument("--netatmo-device-id", help="Netatmo device id")
     parser.add_argument("--log", help="Set log level (default info)", choices=['debug', 'info', 'warning', 'critical'])
     parser.add_argument("--date", help="Copy all readings (max 14/90 days ago)", metavar='YYYY-MM-DD')
-    parser.add_argument("--pv-voltage", help="Send pv voltage instead of grid voltage", action='store_true')
-    parser.add_argument("--skip-offline", help="Skip uploads when inverter is offline", action='store_true')
+    parser.add_argument("--pv-voltage", help="Send pv voltage instead of grid voltage", type=to_bool, nargs='?', const=True)
+    parser.add_argument("--skip-offline", help="Skip uploads when inverter is offline", type=to_bool, nargs='?', const=True)
     parser.add_argument("--city", help="Sets timezone and skip uploads from dusk till dawn")
     parser.add_argument('--csv', help="Append readings to a Excel compatible CSV file, DATE in the name will be replaced by the current date")
     parser.add_argument('--version', action='version', version='%(prog)s ' + __version__)
@@ -179,50 +259,95 @@ def run():
     # Configure the logging
     numeric_level = getattr(logging, args.log.upper(), None)
     if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % loglevel)
+        raise ValueError('Invalid log level: %s' % args.log)
     logging.basicConfig(format='%(levelname)-8s %(message)s', level=numeric_level)
 
-    logging.debug("gw2pvo version " + __version__)
+    log.debug("gw2pvo version %s", __version__)
+
+    # Freeze the parsed configuration into a plain namespace, so the loop reads
+    # plain attributes and all string coercion happens once at startup.
+    settings = SimpleNamespace(**vars(args))
 
-    if isinstance(args.skip_offline, str):
-        args.skip_offline = args.skip_offline.lower() in ['true', 'yes', 'on', '1']
+    # Config-file values bypass the argparse type converter
+    for key in ('skip_offline', 'pv_voltage'):
+        setattr(settings, key, to_bool(getattr(settings, key)))
 
-    if args.gw_station_id is None or args.gw_account is None or args.gw_password is None:
+    settings.pvo_batch_size = min(max(int(settings.pvo_batch_size), 1), 30)
+
+    if settings.gw_station_id is None or settings.gw_account is None or settings.gw_password is None:
         sys.exit("Missing --gw-station-id, --gw-account and/or --gw-password")
 
-    if args.city:
-        city = Location(lookup(args.city, database()))
+    settings.readings_cache = readings_cache_path(settings.gw_station_id)
+
+    if settings.city:
+        city = Location(lookup(settings.city, database()))
         os.environ['TZ'] = city.timezone
         time.tzset()
     else:
         city = None
-    logging.debug("Timezone {}".format(datetime.now().astimezone().tzinfo))
+    log.debug("Timezone %s", datetime.now().astimezone().tzinfo)
 
     # Check if we want to copy old data
-    if args.date:
+    if settings.date:
         try:
-            copy(args)
+            copy(settings)
         except KeyboardInterrupt:
             sys.exit(1)
         except Exception as exp:
-            logging.error(exp)
+            log.error(exp)
         sys.exit()
 
-    startTime = datetime.now()
-
-    while True:
+    # Set the locale once, so the CSV writer can format numbers for Excel
+    try:
+        locale.setlocale(locale.LC_ALL, '')
+    except locale.Error:
+        pass
+    csv = gw_csv.GoodWeCSV(settings.csv) if settings.csv else None
+
+    # Construct the API clients once around a shared keep-alive session, so
+    # their HTTP connections persist across ticks
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    gw = gw_api.GoodWeApi(settings.gw_station_id, settings.gw_account, settings.gw_password, session)
+    if settings.pvo_system_id and settings.pvo_api_key:
+        pvo = pvo_api.PVOutputApi(settings.pvo_system_id, settings.pvo_api_key, session)
+    else:
+        pvo = None
+
+    interval_ns = settings.pvo_interval * 60 * 1_000_000_000 if settings.pvo_interval else None
+    next_tick_ns = time.monotonic_ns()
+    last_eday_kwh = 0
+
+    try:
+        while True:
+            try:
+                last_eday_kwh = run_once(settings, gw, pvo, city, csv, last_eday_kwh)
+            except KeyboardInterrupt:
+                sys.exit(1)
+            except Exception as exp:
+                log.error(exp)
+
+            if interval_ns is None:
+                break
+
+            next_tick_ns += interval_ns
+            delay_ns = next_tick_ns - time.monotonic_ns()
+            if delay_ns <= 0:
+                # run_once overran the interval; skip the missed ticks instead of
+                # firing back-to-back to catch up
+                missed = 1 + (-delay_ns) // interval_ns
+                log.warning("Processing took longer than the interval, skipping %d tick(s)", missed)
+                next_tick_ns += missed * interval_ns
+                delay_ns = next_tick_ns - time.monotonic_ns()
+            # Clamp: the overrun adjustment can leave a tiny negative margin,
+            # and time.sleep rejects negative values
+            time.sleep(max(0, delay_ns) / 1e9)
+    finally:
+        # Don't lose queued readings on exit, interrupt included
         try:
-            run_once(args, city)
-        except KeyboardInterrupt:
-            sys.exit(1)
+            flush_batch(pvo)
         except Exception as exp:
-            logging.error(exp)
-
-        if args.pvo_interval is None:
-            break
-
-        interval = args.pvo_interval * 60
-        time.sleep(interval - (datetime.now() - startTime).seconds % interval)
+            log.error(exp)
 
 if __name__ == "__main__":
     run()
@@ -1,4 +1,5 @@
 import logging
+from collections import deque
 
 __author__ = "Mark Ruys"
 __copyright__ = "Copyright 2017, Mark Ruys"
@@ -10,12 +11,12 @@ class MovingAverage:
     def __init__(self, n):
         self.n = round(n) if n > 0 else 1
         self.denominator = self.n * (self.n + 1) / 2
-        self.queue = []
+        self.queue = deque(maxlen=self.n)
 
     def add(self, x):
 
         if len(self.queue) == 0:
-            self.queue = [x] * self.n
+            self.queue.extend([x] * self.n)
             self.total = sum(self.queue)
             self.numerator = x * self.denominator
 
@@ -23,8 +24,13 @@ class MovingAverage:
 
         self.total += x - self.queue[0]
 
+        # The deque is bounded, so appending drops the oldest sample
         self.queue.append(x)
-        self.queue = self.queue[-self.n:]
 
         return self.numerator / self.denominator
 
+    def add_many(self, xs):
+        ''' Smooth a whole batch of samples in one call. '''
+        add = self.add
+        return [add(x) for x in xs]
+
@@ -1,8 +1,10 @@
 import json
 import logging
+import random
 import time
 from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
 
 __author__ = "Mark Ruys"
 __copyright__ = "Copyright 2017, Mark Ruys"
@@ -11,27 +13,36 @@ __email__ = "mark@paracas.nl"
 
 class GoodWeApi:
 
-    def __init__(self, system_id, account, password):
+    def __init__(self, system_id, account, password, session=None):
         self.system_id = system_id
         self.account = account
         self.password = password
         self.token = '{"version":"v3.1","client":"ios","language":"en"}'
         self.global_url = 'https://semsportal.com/api/'
         self.base_url = self.global_url
+        # Keep-alive session, so repeated calls reuse the TCP+TLS connection
+        if session:
+            self.session = session
+        else:
+            self.session = requests.Session()
+            self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        # The plant doesn't move, so remember its location after the first fetch
+        self._location = None
+
+    _STATUS = ('Offline', 'Waiting', 'Normal', 'Fault')
 
     def statusText(self, status):
-        labels = { -1 : 'Offline', 0 : 'Waiting', 1 : 'Normal', 2: 'Fault' }
-        return labels[status] if status in labels else 'Unknown'
+        return self._STATUS[status + 1] if -1 <= status <= 2 else 'Unknown'
+
+    _VPV_KEYS = ('vpv1', 'vpv2', 'vpv3', 'vpv4')
 
     def calcPvVoltage(self, data):
-        pv_voltages = [
-            data['vpv' + str(i)]
-            for i in range(1, 5)
-            if 'vpv' + str(i) in data
-            if data['vpv' + str(i)]
-            if data['vpv' + str(i)] < 6553
-        ]
-        return round(sum(pv_voltages), 1)
+        total = 0
+        for key in self._VPV_KEYS:
+            voltage = data.get(key)
+            if voltage and voltage < 6553:
+                total += voltage
+        return round(total, 1)
 
     def getCurrentReadings(self):
         ''' Download the most recent readings from the GoodWe API. '''
@@ -75,11 +86,11 @@ class GoodWeApi:
             result['grid_voltage'] = self.parseValue(inverterData['output_voltage'], 'V')
             result['pv_voltage'] = self.calcPvVoltage(inverterData['d'])
 
-        message = "{status}, {pgrid_w} W now, {eday_kwh} kWh today, {etotal_kwh} kWh all time, {grid_voltage} V grid, {pv_voltage} V PV".format(**result)
+        message = "%(status)s, %(pgrid_w)s W now, %(eday_kwh)s kWh today, %(etotal_kwh)s kWh all time, %(grid_voltage)s V grid, %(pv_voltage)s V PV"
         if result['status'] == 'Normal' or result['status'] == 'Offline':
-            logging.info(message)
+            logging.info(message, result)
         else:
-            logging.warning(message)
+            logging.warning(message, result)
 
         return result
 
@@ -102,18 +113,22 @@ class GoodWeApi:
         return eday_kwh
 
     def getLocation(self):
+        if self._location is not None:
+            return dict(self._location)
+
         payload = {
             'powerStationId' : self.system_id
         }
         data = self.call("v2/PowerStation/GetMonitorDetailByPowerstationId", payload)
         if 'info' not in data:
-            logging.warning("GetMonitorDetailByPowerstationId returned bad data: " + str(data))
+            logging.warning("GetMonitorDetailByPowerstationId returned bad data: %s", data)
             return {}
 
-        return {
+        self._location = {
             'latitude' : data['info'].get('latitude'),
             'longitude' : data['info'].get('longitude'),
         }
+        return dict(self._location)
 
     def getDayPac(self, date):
         payload = {
@@ -122,7 +137,7 @@ class GoodWeApi:
         }
         data = self.call("v2/PowerStationMonitor/GetPowerStationPacByDayForApp", payload)
         if 'pacs' not in data:
-            logging.warning("GetPowerStationPacByDayForApp returned bad data: " + str(data))
+            logging.warning("GetPowerStationPacByDayForApp returned bad data: %s", data)
             return []
 
         return data['pacs']
@@ -135,7 +150,11 @@ class GoodWeApi:
         kwh = 0
         result['entries'] = []
         for sample in pacs:
-            parsed_date = datetime.strptime(sample['date'], "%m/%d/%Y %H:%M:%S")
+            # Fixed-width "%m/%d/%Y %H:%M:%S" parse; much cheaper than strptime
+            # when run for every five-minute sample of the day
+            d = sample['date']
+            parsed_date = datetime(int(d[6:10]), int(d[0:2]), int(d[3:5]),
+                                   int(d[11:13]), int(d[14:16]), int(d[17:19]))
             next_hours = parsed_date.hour + parsed_date.minute / 60
             pgrid_w = sample['pac']
             if pgrid_w > 0:
@@ -155,6 +174,14 @@ class GoodWeApi:
 
         return result
 
+    def _post(self, url, headers, payload):
+        ''' POST and decode a JSON response, raising on transport errors. '''
+        r = self.session.post(url, headers=headers, data=payload, timeout=10)
+        r.raise_for_status()
+        data = r.json()
+        logging.debug(data)
+        return data
+
     def call(self, url, payload):
         for i in range(1, 4):
             try:
@@ -163,10 +190,7 @@ class GoodWeApi:
                     'Token': self.token,
                 }
 
-                r = requests.post(self.base_url + url, headers=headers, data=payload, timeout=10)
-                r.raise_for_status()
-                data = r.json()
-                logging.debug(data)
+                data = self._post(self.base_url + url, headers, payload)
 
                 try:
                     code = int(data['code'])
@@ -180,9 +204,7 @@ class GoodWeApi:
                         'account': self.account,
                         'pwd': self.password,
                     }
-                    r = requests.post(self.global_url + 'v2/Common/CrossLogin', headers=headers, data=loginPayload, timeout=10)
-                    r.raise_for_status()
-                    data = r.json()
+                    data = self._post(self.global_url + 'v2/Common/CrossLogin', headers, loginPayload)
                     if 'api' not in data:
                         raise Exception(data['msg'])
                     self.base_url = data['api']
@@ -191,7 +213,9 @@ class GoodWeApi:
                     raise Exception("Failed to call GoodWe API (code {})".format(code))
             except requests.exceptions.RequestException as exp:
                 logging.warning(exp)
-            time.sleep(i ** 3)
+            # Exponential backoff with jitter, so retries don't align with
+            # other clients hammering a recovering server
+            time.sleep(random.uniform(1, min(2 ** i, 10)))
         else:
             raise Exception("Failed to call GoodWe API (too many retries)")
 
@@ -199,7 +223,11 @@ class GoodWeApi:
 
     def parseValue(self, value, unit):
         try:
-            return float(value.rstrip(unit))
+            # Chop the unit suffix off in one step; rstrip would treat the
+            # unit as a character set and eat trailing digits like the V in 'kV'
+            if value.endswith(unit):
+                value = value[:-len(unit)]
+            return float(value)
         except ValueError as exp:
             logging.warning(exp)
             return 0
@@ -1,6 +1,7 @@
 import logging
 import datetime
 import csv
+import locale
 
 __author__ = "Mark Ruys"
 __copyright__ = "Copyright 2017, Mark Ruys"
@@ -9,43 +10,60 @@ __email__ = "mark@paracas.nl"
 
 class GoodWeCSV:
 
-    def __init__(self, filename):
-        self.filename = filename.replace('DATE', datetime.date.today().isoformat())
+    _ORDER = (
+        'status',
+        'pgrid_w',
+        'eday_kwh',
+        'etotal_kwh',
+    )
+
+    _LABELS = {
+        'status': 'Status',
+        'pgrid_w': 'Power (W)',
+        'eday_kwh': 'Energy today (kWh)',
+        'etotal_kwh': 'Energy total (kWh)',
+    }
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.filename = None
+        self.csvfile = None
+        self.csvwriter = None
+        # Cache the decimal point; the locale is set before we are constructed
+        self.decimal_point = locale.localeconv()['decimal_point']
+
+    def rotate(self):
+        ''' (Re)open the CSV file when the date in its name changes. '''
+        filename = self.pattern.replace('DATE', datetime.date.today().isoformat())
+        if filename == self.filename:
+            return
+
+        if self.csvfile:
+            self.csvfile.close()
 
-    def append(self, data):
-        ''' Append a row to the CSV file. '''
         try:
-            with open(self.filename, 'x', newline='') as csvfile:
+            with open(filename, 'x', newline='') as csvfile:
                 csvfile.write('\ufeff') # Add UTF-8 BOM header
                 csvwriter = csv.writer(csvfile, dialect='excel', delimiter=';')
-                csvwriter.writerow([self.label(field) for field in self.order()])
+                csvwriter.writerow([self._LABELS[field] for field in self._ORDER])
         except:
             pass
 
-        with open(self.filename, 'a', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile, dialect='excel', delimiter=';')
-            csvwriter.writerow([self.format_field(data[field]) for field in self.order()])
+        self.csvfile = open(filename, 'a', newline='')
+        self.csvwriter = csv.writer(self.csvfile, dialect='excel', delimiter=';')
+        self.filename = filename
+
+    def append(self, data):
+        ''' Append a row to the CSV file, keeping it open between appends. '''
+        self.rotate()
+        self.csvwriter.writerow([self.format_field(data[field]) for field in self._ORDER])
+        self.csvfile.flush()
 
     def format_field(self, value):
         ''' Format values while respecting the locale, so Excel opens the CSV properly. '''
         if type(value) is float:
-            return "{:n}".format(value)
+            return str(value).replace('.', self.decimal_point)
         if type(value) is list:
             return "/".join([self.format_field(v) for v in value])
         return value
 
-    def label(self, field):
-        return {
-            'status': 'Status',
-            'pgrid_w': 'Power (W)',
-            'eday_kwh': 'Energy today (kWh)',
-            'etotal_kwh': 'Energy total (kWh)',
-        }[field]
-
-    def order(self):
-        return [
-            'status',
-            'pgrid_w',
-            'eday_kwh',
-            'etotal_kwh',
-        ]
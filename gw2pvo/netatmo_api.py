@@ -66,7 +66,7 @@ class NetatmoApi:
                 return None
             if len(result['body']) == 0:
                 delta *= 2
-                logging.debug("Retry with delta {}".format(delta))
+                logging.debug("Retry with delta %s", delta)
             else:
                 best_distance = 999999
                 for i, station in enumerate(result['body']):
@@ -75,12 +75,12 @@ class NetatmoApi:
                     if distance < best_distance:
                         best_distance = distance
                         best_station = station
-                logging.info("Found device {} ({}, {}) at a distance of {:.0f} meters".format(
+                logging.info("Found device %s (%s, %s) at a distance of %.0f meters",
                     best_station['_id'],
                     best_station['place']['street'],
                     best_station['place']['city'],
                     best_distance,
-                ))
+                )
                 return self.get_temperature(best_station['measures'])
 
         return None
@@ -99,7 +99,8 @@ class NetatmoApi:
     def call(self, command, payload):
         for i in range(1, 4):
             response = self.oauth.get(self._BASE_URL + command, data=payload)
-            logging.debug(response.json())
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(response.json())
             if response.status_code == 200:
                 return response.json()
             time.sleep(i ** 3)
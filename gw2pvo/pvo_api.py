@@ -1,5 +1,7 @@
 import logging
 import time
+from bisect import bisect_left
+from itertools import islice
 import requests
 
 __author__ = "Mark Ruys"
@@ -9,86 +11,128 @@ __email__ = "mark@paracas.nl"
 
 class PVOutputApi:
 
-    def __init__(self, system_id, api_key):
+    def __init__(self, system_id, api_key, session=None):
         self.m_system_id = system_id
         self.m_api_key = api_key
+        # Keep-alive session, so repeated calls reuse the TCP+TLS connection
+        self.session = session if session else requests.Session()
+        # The headers never change, so build them once; they stay off the
+        # session, which may be shared with other API clients
+        self.headers = {
+            'X-Pvoutput-Apikey' : self.m_api_key,
+            'X-Pvoutput-SystemId' : self.m_system_id,
+            'X-Rate-Limit': '1'
+        }
 
     def add_status(self, pgrid_w, eday_kwh, temperature, voltage):
         t = time.localtime()
-        payload = {
-            'd' : "{:04}{:02}{:02}".format(t.tm_year, t.tm_mon, t.tm_mday),
-            't' : "{:02}:{:02}".format(t.tm_hour, t.tm_min),
+        values = {
+            'd' : f"{t.tm_year:04}{t.tm_mon:02}{t.tm_mday:02}",
+            't' : f"{t.tm_hour:02}:{t.tm_min:02}",
             'v1' : round(eday_kwh * 1000),
-            'v2' : round(pgrid_w)
+            'v2' : round(pgrid_w),
+            'v5' : temperature,
+            'v6' : voltage,
         }
+        # Drop the optional fields that have no value
+        payload = { key: value for key, value in values.items() if value is not None }
 
-        if temperature is not None:
-            payload['v5'] = temperature
+        self.call("https://pvoutput.org/service/r2/addstatus.jsp", payload)
 
-        if voltage is not None:
-            payload['v6'] = voltage
+    def format_status(self, pgrid_w, eday_kwh, temperature, voltage):
+        ''' Format a reading for the batch endpoint, stamped with the current time. '''
+        t = time.localtime()
+        fields = [
+            f"{t.tm_year:04}{t.tm_mon:02}{t.tm_mday:02}",
+            f"{t.tm_hour:02}:{t.tm_min:02}",
+            str(round(eday_kwh * 1000)),
+            str(round(pgrid_w)),
+            '',
+            '',
+            str(temperature) if temperature is not None else '',
+            str(voltage) if voltage is not None else '',
+        ]
+        return ",".join(fields)
+
+    def add_batch_status(self, readings):
+        # One POST for up to 30 formatted readings
+        payload = {
+            'data' : ";".join(readings)
+        }
 
-        self.call("https://pvoutput.org/service/r2/addstatus.jsp", payload)
+        self.call("https://pvoutput.org/service/r2/addbatchstatus.jsp", payload)
 
     def add_day(self, data, temperatures):
         # Send day data in batches of 30.
 
-        for chunk in [ data[i:i + 30] for i in range(0, len(data), 30) ]:
+        if not data:
+            return
+
+        # All readings share one date, so format it only once
+        date = data[0]['dt'].strftime('%Y%m%d')
 
-            readings = []
-            for reading in chunk:
-                dt = reading['dt']
-                fields = [
-                    dt.strftime('%Y%m%d'),
-                    dt.strftime('%H:%M'),
-                    str(round(reading['eday_kwh'] * 1000)),
-                    str(reading['pgrid_w'])
-                ]
+        if temperatures is not None:
+            # Pre-sort once, so each reading can find its temperature by bisection
+            samples = sorted((sample['time'], sample['temperature']) for sample in temperatures)
+            temperatures = ([time for time, _ in samples], [value for _, value in samples])
 
-                if temperatures is not None:
-                    fields.append('')
-                    fields.append('')
-                    temperature = list(filter(lambda x: dt.timestamp() > x['time'], temperatures))[-1]
-                    fields.append(str(temperature['temperature']))
+        # Bind the formatter once; the loop body is pure string construction
+        format_reading = self.format_reading
 
-                readings.append(",".join(fields))
+        entries = iter(data)
+        for chunk in iter(lambda: list(islice(entries, 30)), []):
 
             payload = {
-                'data' : ";".join(readings)
+                'data' : ";".join(format_reading(reading, date, temperatures) for reading in chunk)
             }
 
             self.call("https://pvoutput.org/service/r2/addbatchstatus.jsp", payload)
 
+    def format_reading(self, reading, date, temperatures):
+        dt = reading['dt']
+        fields = [
+            date,
+            f"{dt.hour:02}:{dt.minute:02}",
+            str(round(reading['eday_kwh'] * 1000)),
+            str(reading['pgrid_w'])
+        ]
+
+        if temperatures is not None:
+            times, values = temperatures
+            fields.append('')
+            fields.append('')
+            # The last temperature sampled before this reading; clamp so a
+            # reading before the first sample uses that sample instead of
+            # wrapping around to the last one of the day
+            fields.append(str(values[max(bisect_left(times, dt.timestamp()) - 1, 0)]))
+
+        return ",".join(fields)
+
     def call(self, url, payload):
         logging.debug(payload)
 
-        headers = {
-            'X-Pvoutput-Apikey' : self.m_api_key,
-            'X-Pvoutput-SystemId' : self.m_system_id,
-            'X-Rate-Limit': '1'
-        }
-
         for i in range(1, 4):
             try:
-                r = requests.post(url, headers=headers, data=payload, timeout=10)
+                r = self.session.post(url, headers=self.headers, data=payload, timeout=10)
                 if 'X-Rate-Limit-Reset' in r.headers:
                     reset = round(float(r.headers['X-Rate-Limit-Reset']) - time.time())
                 else:
                     reset = 0
                 if 'X-Rate-Limit-Remaining' in r.headers:
                     if int(r.headers['X-Rate-Limit-Remaining']) < 10:
-                        logging.warning("Only {} requests left, reset after {} seconds".format(
+                        logging.warning("Only %s requests left, reset after %s seconds",
                             r.headers['X-Rate-Limit-Remaining'],
-                            reset))
+                            reset)
                 if r.status_code == 403:
+                    # Sleep just until the server says the quota resets
                     logging.warning("Forbidden: " + r.reason)
                     time.sleep(reset + 1)
-                else:
-                    r.raise_for_status()
-                    break
+                    continue
+                r.raise_for_status()
+                break
             except requests.exceptions.RequestException as arg:
                 logging.warning(r.text or str(arg))
-            time.sleep(i ** 3)
+                time.sleep(i ** 3)
         else:
             logging.error("Failed to call PVOutput API")
 